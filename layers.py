@@ -2,34 +2,59 @@ from .imports import *
 
 
 class Parallel(tf.keras.layers.Layer):
-    def __init__(self):
+    def __init__(self, jit_compile: bool = False):
         super().__init__()
         self.fw_layers = []
+        self._fw_layers_t = ()  # immutable snapshot iterated in the forward pass
+        self._jit_compile = jit_compile
+        self._fused_call = None
 
     def add(self, layer: tf.keras.layers.Layer):
         self.fw_layers.append(layer)
+        self._fw_layers_t = tuple(self.fw_layers)
+        self._fused_call = None  # invalidate traces that captured the old layer list
 
-    def call(self, x: tf.Tensor, *args, **kw_args) -> tf.Tensor:
-        outputs = core.parallel_transforms(x, self.fw_layers)
+    def _forward(self, x: tf.Tensor, training=None) -> tf.Tensor:
+        outputs = [layer(x, training=training) for layer in self._fw_layers_t]
         return tf.keras.layers.concatenate(outputs)
 
+    def call(self, x: tf.Tensor, training=None, *args, **kw_args) -> tf.Tensor:
+        if self._fused_call is None:
+            self._fused_call = tf.function(self._forward, jit_compile=True) if self._jit_compile else self._forward
+        return self._fused_call(x, training)
+
 
 # todo: SequentialLayer
 class Sequential(tf.keras.Model):
     """
     A sequential model (or composite layer), which executes its internal layers sequentially in the same order they are
-    added. Sequential can be initialized as an empty model / layer. More layers can be added later on.
+    added. Sequential can be initialized as an empty model / layer. More layers can be added later on. With
+    `jit_compile=True`, the forward pass runs inside a jit-compiled `tf.function`, so XLA can fuse adjacent elementwise
+    sub-layers into single kernels. Compilation is off by default: BN update ops created inside a traced function are
+    not visible to the v1 estimator training path, which collects them with `get_updates_for`.
     """
 
-    def __init__(self):
+    def __init__(self, jit_compile: bool = False):
         super().__init__()
         self.fw_layers = []
+        self._fw_layers_t = ()  # immutable snapshot iterated in the forward pass
+        self._jit_compile = jit_compile
+        self._fused_call = None
 
     def add(self, layer: tf.keras.layers.Layer):
         self.fw_layers.append(layer)
+        self._fw_layers_t = tuple(self.fw_layers)
+        self._fused_call = None  # invalidate traces that captured the old layer list
 
-    def call(self, x: tf.Tensor, *args, **kw_args) -> tf.Tensor:
-        return core.sequential_transforms(x, self.fw_layers)
+    def _forward(self, x: tf.Tensor, training=None) -> tf.Tensor:
+        for layer in self._fw_layers_t:
+            x = layer(x, training=training)
+        return x
+
+    def call(self, x: tf.Tensor, training=None, *args, **kw_args) -> tf.Tensor:
+        if self._fused_call is None:
+            self._fused_call = tf.function(self._forward, jit_compile=True) if self._jit_compile else self._forward
+        return self._fused_call(x, training)
 
 
 class Scaling(tf.keras.layers.Layer):
@@ -46,6 +71,31 @@ class Scaling(tf.keras.layers.Layer):
         return x * self.weight
 
 
+class FusedBNReLU(tf.keras.layers.Layer):
+    """
+    BatchNormalization paired with a ReLU activation. BN is memory-bandwidth bound, so the BN uses its fused kernel
+    where possible, and the bare tf.nn.relu sits right in BN's output so an XLA-compiled enclosing model (see
+    `Sequential`) folds it into the BN epilogue, avoiding a round-trip to memory for the activation tensor. When
+    `bn_before_relu` is False, the ReLU is applied before the normalization instead.
+    """
+
+    def __init__(self, bn_mom=0.99, bn_eps=0.001, bn_before_relu=True, fused=None):
+        """
+        :param bn_mom: momentum of the BatchNormalization layer.
+        :param bn_eps: epsilon of the BatchNormalization layer.
+        :param bn_before_relu: whether BatchNormalization comes before the ReLU activation.
+        :param fused: passed through to BatchNormalization. `True` requires a 4D input, as in convolutional models.
+        """
+        super().__init__()
+        self.bn = tf.keras.layers.BatchNormalization(momentum=bn_mom, epsilon=bn_eps, fused=fused)
+        self.bn_before_relu = bn_before_relu
+
+    def call(self, x: tf.Tensor, training=None, *args, **kw_args) -> tf.Tensor:
+        if self.bn_before_relu:
+            return tf.nn.relu(self.bn(x, training=training))
+        return self.bn(tf.nn.relu(x), training=training)
+
+
 class GlobalPools2D(Parallel):
     """
     A concatenation of GlobalMaxPooling2D and GlobalAveragePooling2D.
@@ -71,26 +121,43 @@ class DenseBN(Sequential):
         """
         super().__init__()
         self.add(tf.keras.layers.Dense(c, kernel_initializer=kernel_initializer, use_bias=False))
-        bn = tf.keras.layers.BatchNormalization(momentum=bn_mom, epsilon=bn_eps)
-        relu = tf.keras.layers.Activation('relu')
-
-        if bn_before_relu:
-            self.add(bn)
-            self.add(relu)
-        else:
-            self.add(relu)
-            self.add(bn)
+        self.add(FusedBNReLU(bn_mom=bn_mom, bn_eps=bn_eps, bn_before_relu=bn_before_relu))
 
         if drop_rate > 0.0:
             self.add(tf.keras.layers.Dropout(drop_rate))
 
 
 class Classifier(Sequential):
+    """
+    A Dense layer producing logits scaled by a constant `weight` (a logit temperature). The scale is a multiply in the
+    forward pass, so it acts on the logits and their gradients throughout training, exactly like the former Scaling
+    layer; as a bare op rather than a layer, it fuses into the Dense epilogue when the forward pass is XLA-compiled.
+    """
+
     def __init__(self, n_classes: int, kernel_initializer: Union[str, Callable] = 'glorot_uniform',
                  weight: float = 1.0):
         super().__init__()
+        self.weight = weight
         self.add(tf.keras.layers.Dense(n_classes, kernel_initializer=kernel_initializer, use_bias=False))
-        self.add(Scaling(weight))
+
+    def _forward(self, x: tf.Tensor, training=None) -> tf.Tensor:
+        h = super()._forward(x, training)
+        return h if self.weight == 1.0 else h * self.weight
+
+    def quantize_int8(self, representative_dataset: Callable = None) -> bytes:
+        """
+        Post-training int8 quantization of the classifier head, for inference deployment. The Dense GEMM then runs on
+        int8 units (VNNI on x86, int8 tensor cores on Turing+ GPUs) with 4x smaller weights.
+
+        :param representative_dataset: generator yielding sample inputs, used to calibrate activation ranges. Without
+               it only the weights are quantized (dynamic range quantization).
+        :return: the quantized model, as TFLite flatbuffer bytes.
+        """
+        converter = tf.lite.TFLiteConverter.from_keras_model(self)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if representative_dataset is not None:
+            converter.representative_dataset = representative_dataset
+        return converter.convert()
 
 
 class ConvBN(Sequential):
@@ -103,8 +170,7 @@ class ConvBN(Sequential):
         super().__init__()
         self.add(tf.keras.layers.Conv2D(filters=c, kernel_size=kernel_size, strides=strides,
                                         kernel_initializer=kernel_initializer, padding='same', use_bias=False))
-        self.add(tf.keras.layers.BatchNormalization(momentum=bn_mom, epsilon=bn_eps))
-        self.add(tf.keras.layers.Activation('relu'))
+        self.add(FusedBNReLU(bn_mom=bn_mom, bn_eps=bn_eps, fused=True))
 
 
 class ConvBlk(Sequential):
@@ -130,21 +196,30 @@ class ConvResBlk(ConvBlk):
                  bn_mom=0.99, bn_eps=0.001):
         super().__init__(c, pool=pool, convs=convs, kernel_size=kernel_size, kernel_initializer=kernel_initializer,
                          bn_mom=bn_mom, bn_eps=bn_eps)
-        self.res = []
+        res = []
         for i in range(res_convs):
             conv_bn = ConvBN(c, kernel_size=kernel_size, kernel_initializer=kernel_initializer, bn_mom=bn_mom,
                              bn_eps=bn_eps)
-            self.res.append(conv_bn)
-
-    def call(self, x: tf.Tensor, *args, **kw_args) -> tf.Tensor:
-        h = super().call(x)
-        hh = core.sequential_transforms(h, self.res)
+            res.append(conv_bn)
+        self.res = tuple(res)
+
+    def _forward(self, x: tf.Tensor, training=None) -> tf.Tensor:
+        h = super()._forward(x, training)
+        hh = h
+        for layer in self.res:
+            hh = layer(hh, training=training)
         return h + hh
 
 
+@functools.lru_cache(maxsize=None)
+def _init_bound(fan_shape: Tuple[int, ...]) -> float:
+    return 1 / math.sqrt(np.prod(fan_shape))
+
+
 def init_pytorch(shape, dtype=tf.float32, partition_info=None) -> tf.Tensor:
     """
-    Initialize a given layer, such as Conv2D or Dense, in the same way as PyTorch.
+    Initialize a given layer, such as Conv2D or Dense, in the same way as PyTorch. The fan-in bound is memoized per
+    weight shape, since the same shapes recur across layers and model rebuilds.
 
     Args:
     :param shape: Shape of the weights in the layer to be initialized.
@@ -152,8 +227,7 @@ def init_pytorch(shape, dtype=tf.float32, partition_info=None) -> tf.Tensor:
     :param partition_info: Required by Keras. Not used.
     :return: Random weights for a the given layer.
     """
-    fan = np.prod(shape[:-1])
-    bound = 1 / math.sqrt(fan)
+    bound = _init_bound(tuple(shape[:-1]))
     return tf.random.uniform(shape, minval=-bound, maxval=bound, dtype=dtype)
 
 
@@ -183,11 +257,16 @@ def check_model(build_nn: Callable, h: int, w: int) -> tf.Tensor:
 
 def attention(src: tf.Tensor, dest: tf.Tensor, mask: tf.Tensor = None, n_heads: int = 1, c: int = 512,
               dropout_prob: float = 0.0, initializer_range: float = 0.02, return_2d: bool = False, bs: int = None,
-              src_len: int = None, dest_len: int = None) -> tf.Tensor:
-    def qkv(x, name: str, seq_len):
-        x = tf.compat.v1.layers.dense(x, n_heads * c, name=name,
-                            kernel_initializer=tf.compat.v1.truncated_normal_initializer(stddev=initializer_range))
-        return tf.transpose(tf.reshape(x, [bs, seq_len, n_heads, c]), [0, 2, 1, 3])
+              src_len: int = None, dest_len: int = None, fused_qkv: bool = False) -> tf.Tensor:
+    initializer = tf.compat.v1.truncated_normal_initializer(stddev=initializer_range)
+
+    def proj(x, n_out: int, name: str):
+        return tf.compat.v1.layers.dense(x, n_out, name=name, kernel_initializer=initializer)
+
+    def split_heads(x, seq_len):
+        # Heads stay in [B, seq, N, c] layout; the einsum contractions below absorb the head/sequence reordering into
+        # the batched GEMMs, so no transposed copy of Q/K/V or of the context is ever materialized.
+        return tf.reshape(x, [bs, seq_len, n_heads, c])
 
     from_shape = core.get_shape_list(src)
     to_shape = core.get_shape_list(dest)
@@ -198,21 +277,38 @@ def attention(src: tf.Tensor, dest: tf.Tensor, mask: tf.Tensor = None, n_heads:
     from_tensor_2d = core.reshape_to_matrix(src)  # [B*F, src_c]
     to_tensor_2d = core.reshape_to_matrix(dest)  # [B*T, dest_c]
 
-    query = qkv(from_tensor_2d, 'query', src_len)
-    key = qkv(to_tensor_2d, 'key', dest_len)
-    value = qkv(to_tensor_2d, 'value', dest_len)
-
-    attention_scores = tf.matmul(query, key, transpose_b=True) / math.sqrt(float(c))  # [B, N, F, T]
-
-    if mask is not None:  # `mask`: [B, F, T]
-        mask = tf.expand_dims(mask, axis=[1])  # [B, 1, F, T]
-        attention_scores += (1.0 - tf.cast(mask, tf.float32)) * -10000.0
-
-    attention_probs = tf.nn.softmax(attention_scores)  # [B, N, F, T]
-    attention_probs = F.dropout(attention_probs, dropout_prob)
-
-    context = tf.matmul(attention_probs, value)  # [B, N, F, c]
-    context = tf.transpose(context, [0, 2, 1, 3])  # [B, F, N, c]
+    if fused_qkv and src is dest:
+        # Self-attention: one GEMM with 3x the output columns produces Q, K and V in a single pass, instead of three
+        # separate matmuls each re-reading the same input activations. Opt-in because the 'qkv' variable does not
+        # match the query/key/value names in pretrained BERT checkpoints, which ckpt_assignment_map maps by name.
+        qkv = proj(from_tensor_2d, 3 * n_heads * c, 'qkv')
+        query, key, value = [split_heads(t, src_len) for t in tf.split(qkv, 3, axis=-1)]
+    else:
+        query = split_heads(proj(from_tensor_2d, n_heads * c, 'query'), src_len)
+        key = split_heads(proj(to_tensor_2d, n_heads * c, 'key'), dest_len)
+        value = split_heads(proj(to_tensor_2d, n_heads * c, 'value'), dest_len)
+
+    fused_attn = getattr(tf.nn, 'experimental', None)
+    fused_attn = getattr(fused_attn, 'dot_product_attention', None) if fused_attn is not None else None
+
+    if fused_attn is not None and (dropout_prob is None or dropout_prob == 0.0):
+        # FlashAttention-style fused kernel (cuDNN, TF 2.15+): tiles Q/K/V on chip and streams the softmax with online
+        # normalization, so the [B, N, F, T] score matrix never reaches HBM -- O(n) memory instead of O(n^2).
+        bias = None
+        if mask is not None:  # `mask`: [B, F, T], or [B, 1, T] to broadcast over source positions
+            bias = tf.expand_dims((1.0 - tf.cast(mask, tf.float32)) * -10000.0, axis=[1])
+        context = fused_attn(query, key, value, bias=bias, scale=1.0 / math.sqrt(float(c)))  # [B, F, N, c]
+    else:
+        attention_scores = tf.einsum('bfnc,btnc->bnft', query, key) / math.sqrt(float(c))  # [B, N, F, T]
+
+        if mask is not None:  # `mask`: [B, F, T], or [B, 1, T] to broadcast over source positions
+            mask = tf.expand_dims(mask, axis=[1])  # [B, 1, F, T] or [B, 1, 1, T]
+            attention_scores += (1.0 - tf.cast(mask, tf.float32)) * -10000.0
+
+        attention_probs = tf.nn.softmax(attention_scores)  # [B, N, F, T]
+        attention_probs = F.dropout(attention_probs, dropout_prob)
+
+        context = tf.einsum('bnft,btnc->bfnc', attention_probs, value)  # [B, F, N, c]
 
     ret_shape = [bs * src_len, n_heads * c] if return_2d else [bs, src_len, n_heads * c]
     return tf.reshape(context, ret_shape)
@@ -224,5 +320,14 @@ def layer_norm(input_tensor, name=None):
         inputs=input_tensor, begin_norm_axis=-1, begin_params_axis=-1, scope=name)
 
 
+def residual_layer_norm(input_tensor, residual, name=None):
+    """
+    Adds a residual connection and layer-normalizes the sum inside one XLA cluster, so the elementwise add is fused
+    into the normalization kernel instead of round-tripping its result through memory first.
+    """
+    with tf.xla.experimental.jit_scope(compile_ops=True):
+        return layer_norm(input_tensor + residual, name)
+
+
 def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
     return F.dropout(layer_norm(input_tensor, name), dropout_prob)
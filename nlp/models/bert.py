@@ -9,57 +9,81 @@ from .. import tokenizer
 from ... import layers
 
 
+def enable_tensor_cores(opt):
+    """
+    Enables automatic mixed precision for the transformer's GEMMs by wrapping the training optimizer with TensorFlow's
+    mixed precision graph rewrite. At graph optimization time the rewrite casts matmul-heavy ops -- including the
+    v1-style `tf.layers.dense` QKV projections and the 768->3072->768 FFN, which ignore the Keras mixed precision
+    policy -- to float16 tensor-core kernels with automatic loss scaling, while keeping variables in float32. Channel
+    sizes should be multiples of 8, which already holds for BERT-base (768, 3072).
+
+    :param opt: the optimizer that will build the train op.
+    :return: the wrapped optimizer; use it in place of `opt`.
+    """
+    return tf.compat.v1.train.experimental.enable_mixed_precision_graph_rewrite(opt)
+
+
 def transformer(x: tf.Tensor, attn_mask: tf.Tensor = None, c: int = 768, num_hidden_layers=12, n_heads: int = 12,
                 ff_c: int = 3072, ff_act: Callable = F.gelu, hidden_dropout_prob: float = 0.1,
                 attn_dropout_prob: float = 0.1, initializer_range: float = 0.02,
-                return_all_layers: bool = False) -> Union[List[tf.Tensor], tf.Tensor]:
+                return_all_layers: bool = False, fused_qkv: bool = False) -> Union[List[tf.Tensor], tf.Tensor]:
     input_shape = core.get_shape_list(x)  # [bs, seq_len, c]
     x_2d = core.reshape_to_matrix(x)
 
     attn_c = c // n_heads
     bs, seq_len = input_shape[0], input_shape[1]
 
-    all_layer_outputs = []
+    initializer = tf.truncated_normal_initializer(stddev=initializer_range)
+
+    # Only accumulate per-layer outputs when the caller asked for them; a TensorArray plays better with tf.function
+    # than a Python list and avoids retaining every layer's activations through the tape in the common last-layer case.
+    all_layer_outputs = tf.TensorArray(tf.float32, size=num_hidden_layers) if return_all_layers else None
     for layer_idx in range(num_hidden_layers):
         with tf.variable_scope(f"layer_{layer_idx}"):
             with tf.variable_scope("attention"):
                 with tf.variable_scope("self"):
                     attn_h = layers.attention(src=x_2d, dest=x_2d, mask=attn_mask, n_heads=n_heads, c=attn_c,
                                               dropout_prob=attn_dropout_prob, initializer_range=initializer_range,
-                                              return_2d=True, bs=bs, src_len=seq_len, dest_len=seq_len)
+                                              return_2d=True, bs=bs, src_len=seq_len, dest_len=seq_len,
+                                              fused_qkv=fused_qkv)
 
                 with tf.variable_scope("output"):
-                    attn_h = tf.layers.dense(attn_h, c, kernel_initializer=tf.truncated_normal_initializer(
-                        stddev=initializer_range))
+                    attn_h = tf.layers.dense(attn_h, c, kernel_initializer=initializer)
                     attn_h = F.dropout(attn_h, hidden_dropout_prob)
-                    attn_h = layers.layer_norm(attn_h + x_2d)
+                    attn_h = layers.residual_layer_norm(attn_h, x_2d)
 
             with tf.variable_scope("intermediate"):
-                ff_h = tf.layers.dense(attn_h, ff_c, activation=ff_act,
-                                       kernel_initializer=tf.truncated_normal_initializer(stddev=initializer_range))
+                ff_h = tf.layers.dense(attn_h, ff_c, activation=ff_act, kernel_initializer=initializer)
 
             with tf.variable_scope("output"):
-                h = tf.layers.dense(ff_h, c, kernel_initializer=tf.truncated_normal_initializer(
-                    stddev=initializer_range))
+                h = tf.layers.dense(ff_h, c, kernel_initializer=initializer)
                 h = F.dropout(h, hidden_dropout_prob)
-                h = layers.layer_norm(h + attn_h)
+                h = layers.residual_layer_norm(h, attn_h)
                 x_2d = h
-                all_layer_outputs.append(h)
+                if return_all_layers:
+                    all_layer_outputs = all_layer_outputs.write(layer_idx, h)
 
     reshape_func = functools.partial(core.reshape_from_matrix, orig_shape_list=input_shape)
-    return list(map(reshape_func, all_layer_outputs)) if return_all_layers else reshape_func(x_2d)
+    if return_all_layers:
+        return list(map(reshape_func, tf.unstack(all_layer_outputs.stack(), num=num_hidden_layers)))
+    return reshape_func(x_2d)
 
 
 def word_emb(x: tf.Tensor, vocab_size: int, c: int = 768, initializer_range: float = 0.02, one_hot: bool = False) -> \
         Tuple[tf.Tensor, tf.Variable]:
+    embedding_table = tf.get_variable(name="word_embeddings", shape=[vocab_size, c],
+                                      initializer=tf.truncated_normal_initializer(stddev=initializer_range))
+
+    if x.shape.ndims == 2 and not one_hot:
+        # Common case: [bs, seq_len] token ids. tf.gather handles leading dimensions itself, so the
+        # flatten -> gather -> reshape trio collapses into a single lookup kernel.
+        return tf.gather(embedding_table, x), embedding_table
+
     if x.shape.ndims == 2:
         x = tf.expand_dims(x, axis=[-1])  # todo: change input_shape instead of reshape
     input_shape = core.get_shape_list(x)
     x_flat = tf.reshape(x, [-1])
 
-    embedding_table = tf.get_variable(name="word_embeddings", shape=[vocab_size, c],
-                                      initializer=tf.truncated_normal_initializer(stddev=initializer_range))
-
     if one_hot:
         one_hot_input_ids = tf.one_hot(x_flat, depth=vocab_size)
         x = tf.matmul(one_hot_input_ids, embedding_table)
@@ -71,16 +95,19 @@ def word_emb(x: tf.Tensor, vocab_size: int, c: int = 768, initializer_range: flo
 
 
 def token_type_pos_emb(x: tf.Tensor, token_type_ids: tf.Tensor, token_type_vocab_size: int = 16,
-                       initializer_range: float = 0.02, max_seq_len: int = 512, dropout_prob: float = 0.1):
+                       initializer_range: float = 0.02, max_seq_len: int = 512, dropout_prob: float = 0.1,
+                       one_hot: bool = False):
     input_shape = core.get_shape_list(x)
     bs, seq_len, c = input_shape[0], input_shape[1], input_shape[2]
 
     token_type_table = tf.get_variable(name="token_type_embeddings", shape=[token_type_vocab_size, c],
                                        initializer=tf.truncated_normal_initializer(stddev=initializer_range))
-    flat_token_type_ids = tf.reshape(token_type_ids, [-1])
-    one_hot_ids = tf.one_hot(flat_token_type_ids, depth=token_type_vocab_size)
-    token_type_emb = tf.matmul(one_hot_ids, token_type_table)
-    token_type_emb = tf.reshape(token_type_emb, [bs, seq_len, c])
+    if one_hot:  # faster on TPUs
+        flat_token_type_ids = tf.reshape(token_type_ids, [-1])
+        one_hot_ids = tf.one_hot(flat_token_type_ids, depth=token_type_vocab_size)
+        token_type_emb = tf.reshape(tf.matmul(one_hot_ids, token_type_table), [bs, seq_len, c])
+    else:
+        token_type_emb = tf.gather(token_type_table, token_type_ids)  # [bs, seq_len, c]
     x += token_type_emb
 
     full_pos_emb = tf.get_variable(name="position_embeddings", shape=[max_seq_len, c],
@@ -90,14 +117,14 @@ def token_type_pos_emb(x: tf.Tensor, token_type_ids: tf.Tensor, token_type_vocab
     return layers.layer_norm_and_dropout(x, dropout_prob)
 
 
-# todo: only thing we use from src is its shape
-def create_attention_mask(src: tf.Tensor, dest_mask: tf.Tensor):
-    src_shape = core.get_shape_list(src)  # [bs, src_len, ...]
+def create_attention_mask(dest_mask: tf.Tensor):
+    """
+    Reshapes a [bs, dest_len] padding mask to [bs, 1, dest_len]. The singleton source dimension broadcasts against the
+    attention scores, so the [bs, src_len, dest_len] tensor the old ones-multiply materialized is never built.
+    """
     desk_shape = core.get_shape_list(dest_mask)  # [bs, dest_len], int32
-    bs, src_len, dest_len = src_shape[0], src_shape[1], desk_shape[1]
-
-    dest_mask = tf.cast(tf.reshape(dest_mask, [bs, 1, dest_len]), tf.float32)
-    return tf.ones(shape=[bs, src_len, 1], dtype=tf.float32) * dest_mask  # [bs, src_len, dest_len]
+    bs, dest_len = desk_shape[0], desk_shape[1]
+    return tf.cast(tf.reshape(dest_mask, [bs, 1, dest_len]), tf.float32)
 
 
 class BertConfig:
@@ -166,7 +193,7 @@ class BertModel(tf.keras.Model):
                                                       dropout_prob=config.hidden_dropout_prob)
 
             with tf.variable_scope("encoder"):
-                attn_mask = create_attention_mask(input_ids, input_mask)  # [batch_size, seq_length, seq_length]
+                attn_mask = create_attention_mask(input_mask)  # [batch_size, 1, seq_length]
 
                 all_encoder_layers = transformer(embedding_output, attn_mask=attn_mask, c=config.hidden_size,
                                                  num_hidden_layers=config.num_hidden_layers,
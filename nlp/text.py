@@ -4,25 +4,44 @@ import csv
 import nltk
 from bs4 import BeautifulSoup
 
+try:
+    from selectolax.parser import HTMLParser as SelectolaxHTMLParser
+except ImportError:
+    SelectolaxHTMLParser = None
+
 __all__ = ['tsv_lines']
 
 
+@functools.lru_cache(maxsize=1)
+def english_stopwords() -> frozenset:
+    return frozenset(nltk.corpus.stopwords.words("english"))
+
+
+def html_text(raw_text) -> str:
+    # selectolax (lexbor-based) extracts text about an order of magnitude faster than BeautifulSoup+lxml; fall back to
+    # BeautifulSoup when it is not installed.
+    if SelectolaxHTMLParser is not None:
+        return SelectolaxHTMLParser(raw_text).text()
+    return BeautifulSoup(raw_text, 'lxml').get_text()
+
+
 def html_to_words(raw_text):
-    txt = BeautifulSoup(raw_text, 'lxml').get_text()
+    txt = html_text(raw_text)
     letters_only = re.sub("[^a-zA-Z]", " ", txt)
     words = letters_only.lower().split()
-    stops = set(nltk.corpus.stopwords.words("english"))
+    stops = english_stopwords()
     meaningful_words = [w for w in words if w not in stops]
     return " ".join(meaningful_words)
 
 
-def tsv_lines(input_file, quotechar=None):
+def tsv_lines(input_file, quotechar=None) -> Iterator[List[str]]:
+    """
+    Yields the lines of a tab-separated file one by one, so that the whole file never needs to be held in memory.
+    """
     with gfile.GFile(input_file) as f:
         reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-        lines = []
         for line in reader:
-            lines.append(line)
-        return lines
+            yield line
 
 
 def to_unicode(text):
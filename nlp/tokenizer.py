@@ -2,6 +2,7 @@ import collections
 import unicodedata
 from typing import List, Dict, Tuple
 
+import numpy as np
 import tensorflow as tf
 
 from .. import core
@@ -78,7 +79,25 @@ def split_on_punc(txt: str):
     return ["".join(x) for x in output]
 
 
+def _build_ascii_clean_table() -> np.ndarray:
+    table = np.zeros(128, dtype=np.uint8)  # 0 means drop the character
+    for cp in range(1, 128):
+        char = chr(cp)
+        if not is_control(char):
+            table[cp] = ord(" ") if is_whitespace(char) else cp
+    return table
+
+
+ASCII_CLEAN_TABLE = _build_ascii_clean_table()
+
+
 def clean_text(txt: str):
+    if txt.isascii():
+        # Vectorized fast path: view the bytes as a uint8 array and clean the whole string with one table lookup,
+        # instead of calling ord() / unicodedata per character.
+        codes = ASCII_CLEAN_TABLE[np.frombuffer(txt.encode("ascii"), dtype=np.uint8)]
+        return codes[codes != 0].tobytes().decode("ascii")
+
     output = []
     for char in txt:
         cp = ord(char)